@@ -1,21 +1,56 @@
 import argparse
 import asyncio
+import base64
+import functools
+import gzip
+import hashlib
+import importlib.util
 import json
 import os
 import random
-from collections import deque
+import re
+import time
+import zlib
 from dataclasses import dataclass
-from typing import Callable, Deque, Dict, List, Optional, Set
+from typing import BinaryIO, Callable, List, Optional, Set, Tuple
+
+
+QUESTION_COLUMN = "question"
+MAX_RETRY_BACKOFF = 30.0  # 秒：指数退避的上限
+WRITER_IDLE_FLUSH = 0.1  # 秒：结果队列空闲多久后写回已缓冲的记录
+RESUME_INDEX_SUFFIX = ".resume.json"  # 与输出文件并列的续跑索引
+INDEX_SAVE_INTERVAL = 1.0  # 秒：两次写回续跑索引之间的最短间隔
+GZIP_IDLE_FLUSH_INTERVAL = 1.0  # 秒：.gz 输出两次空闲写回的最短间隔，避免产生大量压缩比很差的小块
 
 
 class PromptLoadError(RuntimeError):
     """Raised when a system prompt cannot be loaded from disk."""
 
 
+import httpx
 import pandas as pd
-from openai import AsyncOpenAI
+from openai import APIStatusError, AsyncOpenAI
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:  # 可选依赖：未安装时退回标准库 json
+    orjson = None
+
+
+def _json_dumps(obj: object) -> bytes:
+    """Serialize ``obj`` to compact UTF-8 JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data: bytes) -> object:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def load_system_prompt_from_markdown(path: str) -> str:
     """Read a system prompt from a Markdown file."""
@@ -35,15 +70,68 @@ def load_system_prompt_from_markdown(path: str) -> str:
     return content
 
 
-@dataclass
-class CacheRecord:
-    """Represents an instruction waiting to be processed."""
+def _make_http_client(concurrency: int) -> httpx.AsyncClient:
+    """Keep-alive pool sized to ``concurrency`` so busy slots never reconnect."""
+
+    return httpx.AsyncClient(
+        # HTTP/2 需要 h2（httpx[http2]），未安装时使用 HTTP/1.1 连接池
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(
+            max_keepalive_connections=concurrency,
+            max_connections=concurrency,
+            keepalive_expiry=60.0,
+        ),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        follow_redirects=True,
+    )
+
 
-    instruction: str
+def _is_retryable(exc: Exception) -> bool:
+    """Client errors (bad request, auth, ...) fail the same way on every retry."""
 
+    if isinstance(exc, APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return True
 
-def _make_record(q: str, output_text: str) -> Dict[str, str]:
-    return {"instruction": q, "input": "", "output": output_text if output_text else "[EMPTY]"}
+
+def _retry_delay(exc: Exception, retries: int) -> float:
+    """Capped exponential backoff with jitter; honours ``Retry-After`` when the server sends it."""
+
+    delay = float(2 ** retries)
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            delay = max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return min(delay, MAX_RETRY_BACKOFF) + random.random() * 0.3
+
+
+def _cache_prompt_variants(dropout_fn: Callable[[str, float], str], variants: int) -> Callable[[str, float], str]:
+    """Wrap ``dropout_fn`` so that at most ``variants`` distinct prompts are rendered.
+
+    Each call picks a random slot; a slot is rendered once and then reused. The
+    repeated system prompts also hit the provider-side prompt prefix cache.
+    """
+
+    @functools.lru_cache(maxsize=variants)
+    def render(prompt: str, dropout_rate: float, slot: int) -> str:
+        del slot  # 仅作为缓存键
+        return dropout_fn(prompt, dropout_rate=dropout_rate)
+
+    def cached(prompt: str, dropout_rate: float = 0.5) -> str:
+        return render(prompt, dropout_rate, random.randrange(variants))
+
+    return cached
+
+
+# 单条 JSONL 记录的字节模板：直接拼接已转义的字段，省去中间 dict
+_LINE_TEMPLATE = b'{"instruction":%s,"input":"","output":%s}\n'
+
+
+def _make_record(q: str, output_text: str) -> bytes:
+    return _LINE_TEMPLATE % (_json_dumps(q), _json_dumps(output_text if output_text else "[EMPTY]"))
 
 
 async def _call_one(
@@ -51,100 +139,408 @@ async def _call_one(
     model: str,
     q: str,
     include_cot: bool,
-    think_tag: str,
+    think_tags: Tuple[str, str],
     max_retries: int,
     base_prompt: str,
-    dropout_fn: Callable[[str, float], str],
+    dropout_fn: Optional[Callable[[str, float], str]],
+    sem: asyncio.Semaphore,
     dropout_rate: float = 0.5,
-) -> Dict[str, str]:
+) -> bytes:
     retries = 0
     while retries < max_retries:
         try:
-            sys_prompt = dropout_fn(base_prompt, dropout_rate=dropout_rate)
-            resp = await client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": sys_prompt},
-                    {"role": "user", "content": q},
-                ],
-                extra_body={"enable_thinking": True},
-                temperature=0.7,
-                max_tokens=512,
-            )
-            raw = resp.model_dump()
-            ch = raw["choices"][0]
-            msg = ch.get("message", {}) or {}
-            answer = (msg.get("content") or "").strip()
-            cot = (msg.get("reasoning_content") or ch.get("reasoning_content") or "").strip()
+            if dropout_fn is not None and dropout_rate > 0:
+                sys_prompt = dropout_fn(base_prompt, dropout_rate=dropout_rate)
+            else:
+                sys_prompt = base_prompt
+            # 只在请求进行中占用并发名额，退避等待期间释放给其他请求
+            async with sem:
+                resp = await client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": sys_prompt},
+                        {"role": "user", "content": q},
+                    ],
+                    extra_body={"enable_thinking": True},
+                    temperature=0.7,
+                    max_tokens=512,
+                )
+            ch = resp.choices[0]
+            msg = ch.message
+            answer = (getattr(msg, "content", None) or "").strip()
+            # reasoning_content 是兼容服务的扩展字段，pydantic 以 extra 属性保留
+            cot = (
+                getattr(msg, "reasoning_content", None) or getattr(ch, "reasoning_content", None) or ""
+            ).strip()
             if include_cot and cot:
-                output_text = f"<{think_tag}>{cot}</{think_tag}>\n{answer}" if answer else f"<{think_tag}>{cot}</{think_tag}>"
+                open_tag, close_tag = think_tags
+                if answer:
+                    output_text = "".join((open_tag, cot, close_tag, "\n", answer))
+                else:
+                    output_text = "".join((open_tag, cot, close_tag))
             else:
                 output_text = answer
             return _make_record(q, output_text)
-        except Exception:
+        except Exception as exc:
             retries += 1
-            await asyncio.sleep((2 ** retries) + random.random() * 0.3)
-            if retries >= max_retries:
+            if retries >= max_retries or not _is_retryable(exc):
                 return _make_record(q, "[ERROR]")
+            await asyncio.sleep(_retry_delay(exc, retries))
     return _make_record(q, "[ERROR]")
 
 
+def _load_questions(path: str) -> List[str]:
+    """Read the ``question`` column from an Excel, CSV or Parquet file."""
+
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".csv":
+        df = pd.read_csv(path, usecols=[QUESTION_COLUMN], dtype=str)
+    elif suffix == ".parquet":
+        df = pd.read_parquet(path, columns=[QUESTION_COLUMN])
+    else:
+        # calamine（Rust 实现）比默认的 openpyxl 快得多，未安装时退回 pandas 默认引擎
+        engine = "calamine" if importlib.util.find_spec("python_calamine") else None
+        df = pd.read_excel(path, usecols=[QUESTION_COLUMN], engine=engine, dtype=str)
+    # numpy 对象数组的 tolist() 省去 Series 逐元素的空值检查
+    return df[QUESTION_COLUMN].dropna().to_numpy(dtype=object, copy=False).tolist()
+
+
+# 断点续跑只需要 instruction 字段：直接在字节层面截取，避免解码体积很大的 output。
+# 只匹配本脚本写出的记录布局，其余格式走完整解析。
+_INSTRUCTION_RE = re.compile(rb'\{"instruction":"((?:[^"\\]|\\.)*)","input":"","output":"')
+
+
+def _has_closed_tail(line: bytes, output_start: int) -> bool:
+    """Whether ``line`` ends with the unescaped ``"}`` that closes the output string.
+
+    ``output_start`` is the offset just past the opening quote of ``output``; the
+    closing quote must come after it, otherwise the line was cut off right after
+    an output that itself starts with ``}``.
+    """
+
+    close_quote = len(line) - 2
+    if close_quote < output_start or not line.endswith(b'"}'):
+        return False
+    # 引号前连续反斜杠为偶数个时，该引号才是字符串结束符而非 \" 转义
+    pos = close_quote - 1
+    while pos >= output_start and line[pos] == 0x5C:
+        pos -= 1
+    return (close_quote - 1 - pos) % 2 == 0
+
+
+def _extract_instruction(line: bytes) -> Optional[str]:
+    """Return the ``instruction`` of a single JSONL record, or ``None``."""
+
+    match = _INSTRUCTION_RE.match(line)
+    if match is not None and _has_closed_tail(line, match.end()):
+        raw = match.group(1)
+        try:
+            if b"\\" not in raw:
+                return raw.decode("utf-8")
+            return _json_loads(b'"' + raw + b'"')  # type: ignore[return-value]
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            pass
+    # Fallback: other layouts (older versions, other tools) and records of uncertain completeness.
+    try:
+        item = _json_loads(line)
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+    if not isinstance(item, dict):
+        return None
+    instruction = item.get("instruction")
+    return instruction if isinstance(instruction, str) else None
+
+
+def _is_gzip_path(path: str) -> bool:
+    return path.endswith(".gz")
+
+
+def _open_records(path: str) -> BinaryIO:
+    if _is_gzip_path(path):
+        return gzip.open(path, "rb")  # type: ignore[return-value]
+    return open(path, "rb", buffering=1 << 20)
+
+
+class _GzipMemberWriter:
+    """Append every write as a complete gzip member.
+
+    A crash can then only lose the member being written, never damage the ones
+    before it, and later runs can keep appending to a readable stream.
+    """
+
+    def __init__(self, fh: BinaryIO) -> None:
+        self._fh = fh
+
+    def write(self, data: bytes) -> int:
+        # 压缩级别 1 接近 memcpy 速度，长文本仍有数倍压缩比
+        return self._fh.write(gzip.compress(data, compresslevel=1))
+
+    def flush(self) -> None:
+        self._fh.flush()
+
+    def close(self) -> None:
+        self._fh.close()
+
+    def __enter__(self) -> "_GzipMemberWriter":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def _has_complete_gzip_member(data: bytes) -> bool:
+    """Whether a whole gzip member starts anywhere inside ``data``."""
+
+    pos = data.find(b"\x1f\x8b\x08")
+    while pos != -1:
+        decomp = zlib.decompressobj(wbits=31)
+        try:
+            decomp.decompress(data[pos:])
+            if decomp.eof:
+                return True
+        except zlib.error:
+            pass
+        pos = data.find(b"\x1f\x8b\x08", pos + 1)
+    return False
+
+
+def _truncate_partial_gzip(path: str) -> None:
+    """Cut off the unfinished last gzip member a crashed run leaves behind.
+
+    Any other damage raises ``RuntimeError`` and leaves the file untouched.
+    """
+
+    good = 0
+    offset = 0
+    decomp = zlib.decompressobj(wbits=31)
+    with open(path, "rb") as f:
+        try:
+            pending = b""
+            while True:
+                if not pending:
+                    pending = f.read(1 << 20)
+                    if not pending:
+                        break
+                    offset += len(pending)
+                decomp.decompress(pending)
+                if decomp.eof:
+                    pending = decomp.unused_data
+                    good = offset - len(pending)
+                    decomp = zlib.decompressobj(wbits=31)
+                else:
+                    pending = b""
+        except zlib.error as exc:
+            raise RuntimeError(
+                f"{path} is not a valid gzip stream after byte {good}; move it aside before resuming"
+            ) from exc
+        if good == offset:
+            return
+        # 解压器读到文件末尾仍未结束：只有其后再无完整压缩块时才是中断留下的残块
+        f.seek(good + 1)
+        if _has_complete_gzip_member(f.read()):
+            raise RuntimeError(
+                f"{path} has a damaged gzip member at byte {good}; move it aside before resuming"
+            )
+    os.truncate(path, good)
+
+
+def _open_output(path: str) -> BinaryIO:
+    """Open the output for appending; ``.gz`` paths are written as gzip members."""
+
+    if _is_gzip_path(path):
+        # 每次写入的记录都以换行结尾，无需补换行
+        return _GzipMemberWriter(open(path, "ab"))  # type: ignore[return-value]
+    fh = open(path, "a+b")
+    _ensure_trailing_newline(fh)
+    return fh
+
+
+def _scan_output(path: str) -> Set[str]:
+    if _is_gzip_path(path) and os.path.exists(path):
+        # 先截掉中断留下的残缺压缩块，否则之后追加的数据整个文件都无法解压
+        _truncate_partial_gzip(path)
+    return _load_existing_records(path)
+
+
 def _load_existing_records(path: str) -> Set[str]:
     processed: Set[str] = set()
     if not os.path.exists(path):
         return processed
     try:
-        with open(path, "r", encoding="utf-8") as f:
+        with _open_records(path) as f:
             for line in f:
                 line = line.strip()
                 if not line:
                     continue
-                try:
-                    item = json.loads(line)
-                except json.JSONDecodeError:
-                    continue
-                instruction = item.get("instruction")
-                if isinstance(instruction, str) and instruction:
+                instruction = _extract_instruction(line)
+                if instruction:
                     processed.add(instruction)
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        # 压缩流在中断时可能被截断：保留截断点之前已读到的记录
+        return processed
     except Exception:
         # Ignore corrupted cache; caller will handle warning/logging.
         return set()
     return processed
 
 
-def _file_needs_leading_newline(path: str) -> bool:
-    if not os.path.exists(path) or os.path.getsize(path) == 0:
-        return False
-    try:
-        with open(path, "rb") as f:
-            f.seek(-1, os.SEEK_END)
-            last_char = f.read(1)
-            return last_char not in (b"\n", b"\r")
-    except OSError:
-        return False
+def _file_digest(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class ResumeIndex:
+    """Sidecar next to the output recording which questions already have a record on disk.
+
+    The writer rewrites it after every flush together with the output's size and
+    mtime, so it is only trusted while the output is exactly as that flush left it;
+    otherwise the caller scans the JSONL instead.
+    """
+
+    path: str
+    output_path: str
+    input_path: str
+    input_digest: str = ""
+
+    def __post_init__(self) -> None:
+        stat = os.stat(self.input_path)
+        self.input_stat = (stat.st_size, stat.st_mtime_ns)
+
+    def load(self) -> Optional[Tuple[str, bool, bytearray]]:
+        """Return ``(input_digest, input_unchanged, done)`` saved by the last flush.
+
+        ``input_unchanged`` compares the input file's size and mtime with the
+        saved ones, letting the caller skip re-hashing an untouched input.
+        """
+
+        try:
+            with open(self.path, "rb") as f:
+                index = _json_loads(f.read())
+            stat = os.stat(self.output_path)
+            if not isinstance(index, dict):
+                return None
+            if index.get("output_size") != stat.st_size or index.get("output_mtime_ns") != stat.st_mtime_ns:
+                return None
+            input_digest = index["input_digest"]
+            if not isinstance(input_digest, str):
+                return None
+            input_unchanged = (index.get("input_size"), index.get("input_mtime_ns")) == self.input_stat
+            done = bytearray(zlib.decompress(base64.b64decode(index["done"])))
+        except (OSError, ValueError, KeyError, TypeError, zlib.error):
+            return None
+        return input_digest, input_unchanged, done
+
+    def save(self, done: bytearray) -> None:
+        stat = os.stat(self.output_path)
+        index = {
+            "input_digest": self.input_digest,
+            "input_size": self.input_stat[0],
+            "input_mtime_ns": self.input_stat[1],
+            "output_size": stat.st_size,
+            "output_mtime_ns": stat.st_mtime_ns,
+            # 每条问题一个字节的完成标记，压缩后体积很小，可以每次写回都更新
+            "done": base64.b64encode(zlib.compress(done, 1)).decode("ascii"),
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_json_dumps(index))
+        os.replace(tmp_path, self.path)
+
+
+def _ensure_trailing_newline(fh: BinaryIO) -> None:
+    """Terminate the last record of files written by older versions (no trailing newline)."""
+
+    fh.seek(0, os.SEEK_END)
+    if fh.tell() == 0:
+        return
+    fh.seek(-1, os.SEEK_END)
+    if fh.read(1) not in (b"\n", b"\r"):
+        fh.write(b"\n")
+        fh.flush()  # 让随后写入的续跑索引记录到包含该换行的文件大小
 
 
-def _flush_results(path: str, buffer: List[Dict[str, str]]) -> None:
+def _flush_results(
+    fh: BinaryIO,
+    buffer: List[Tuple[int, bytes]],
+    done: bytearray,
+) -> None:
     if not buffer:
         return
-    add_leading_newline = _file_needs_leading_newline(path)
-    with open(path, "a", encoding="utf-8") as f:
-        if add_leading_newline:
-            f.write("\n")
-        for idx, record in enumerate(buffer):
-            if idx > 0:
-                f.write("\n")
-            f.write(json.dumps(record, ensure_ascii=False))
+    fh.write(b"".join(record for _, record in buffer))
+    fh.flush()
+    # 只有已经落盘的记录才标记完成
+    for idx, _ in buffer:
+        done[idx] = 1
     buffer.clear()
 
 
+async def _writer_loop(
+    queue: "asyncio.Queue[Optional[Tuple[int, bytes]]]",
+    fh: BinaryIO,
+    save_every: int,
+    written: int,
+    total: int,
+    done: bytearray,
+    index: ResumeIndex,
+    idle_flush_interval: float = 0.0,
+) -> None:
+    """Drain finished records from ``queue`` and append them to ``fh``.
+
+    Records are written every ``save_every`` items, or as soon as the queue has
+    been idle for ``WRITER_IDLE_FLUSH`` seconds and the last write is at least
+    ``idle_flush_interval`` seconds old. The resume index is saved at
+    most once per ``save_every`` written records or ``INDEX_SAVE_INTERVAL``
+    seconds, and once more at the end. ``None`` stops the loop.
+    """
+
+    buffer: List[Tuple[int, bytes]] = []
+    unsaved = 0
+    last_save = 0.0
+    last_flush = 0.0
+
+    def flush(final: bool = False) -> None:
+        nonlocal unsaved, last_save, last_flush
+        unsaved += len(buffer)
+        _flush_results(fh, buffer, done)
+        # 索引每次都要完整重写：按记录数或时间节流，否则大任务的空闲写回会退化为 O(N²)
+        now = time.monotonic()
+        last_flush = now
+        if final or unsaved >= save_every or (unsaved and now - last_save >= INDEX_SAVE_INTERVAL):
+            index.save(done)
+            unsaved = 0
+            last_save = now
+
+    # 打开输出时可能补写了换行：先按当前状态记一次索引
+    await asyncio.to_thread(flush, True)
+    while True:
+        try:
+            record = await asyncio.wait_for(queue.get(), timeout=WRITER_IDLE_FLUSH)
+        except asyncio.TimeoutError:
+            if buffer and time.monotonic() - last_flush >= idle_flush_interval:
+                written += len(buffer)
+                await asyncio.to_thread(flush)
+            continue
+        if record is None:
+            break
+        buffer.append(record)
+        if len(buffer) >= save_every:
+            written += len(buffer)
+            await asyncio.to_thread(flush)
+            print(f"💾 已写入缓存：{written}/{total}")
+    await asyncio.to_thread(flush, True)
+
+
 async def generate_sft_async(
     api_base: str,
     api_key: str,
     model: str,
     input_file: str,
     output_file: str,
-    batch_size: int = 10,
+    batch_size: int = 10,  # 保留兼容参数
     sleep_time: float = 0.0,  # 保留兼容参数
     save_every: int = 50,
     resume: bool = True,
@@ -155,6 +551,8 @@ async def generate_sft_async(
     base_prompt: Optional[str] = None,
     dropout_fn: Optional[Callable[[str, float], str]] = None,
     system_prompt_markdown: Optional[str] = None,
+    dropout_rate: float = 0.5,
+    prompt_variants: int = 64,
 ) -> None:
     del sleep_time  # 参数兼容：在并发模型中不再逐条 sleep
 
@@ -164,12 +562,20 @@ async def generate_sft_async(
         raise ValueError("batch_size must be greater than 0")
     if save_every <= 0:
         raise ValueError("save_every must be greater than 0")
-
-    if dropout_fn is None:
+    if not 0 <= dropout_rate <= 1:
+        raise ValueError("dropout_rate must be between 0 and 1")
+    if prompt_variants < 0:
+        raise ValueError("prompt_variants must be non-negative")
+
+    if dropout_rate == 0:
+        dropout_fn = None  # 固定使用完整 system prompt，无需逐条渲染
+    elif dropout_fn is None:
         try:
             dropout_fn = prompt_dropout  # type: ignore[name-defined]
         except NameError as exc:
             raise RuntimeError("prompt_dropout function must be provided") from exc
+    if dropout_fn is not None and prompt_variants > 0:
+        dropout_fn = _cache_prompt_variants(dropout_fn, prompt_variants)
 
     prompt_source = base_prompt
     if system_prompt_markdown:
@@ -186,85 +592,147 @@ async def generate_sft_async(
 
     base_prompt_value = prompt_source
 
-    client = AsyncOpenAI(base_url=api_base, api_key=api_key)
-
-    df = pd.read_excel(input_file)
-    questions = df["question"].dropna().tolist()
+    index = ResumeIndex(output_file + RESUME_INDEX_SUFFIX, output_file, input_file)
+    saved = None
+    output_exists = os.path.exists(output_file)
+    if resume and output_exists:
+        saved = index.load()
+    elif not resume:
+        for path in (output_file, index.path):
+            if os.path.exists(path):
+                os.remove(path)
+        output_exists = False
+
+    # 解析 Excel、计算输入摘要与扫描已有 JSONL 互不依赖，放到线程中并行执行。
+    # 输入文件未改动时直接沿用索引中的摘要；否则索引可能失效，同时扫描 JSONL 备用。
+    need_digest = saved is None or not saved[1]
+    need_scan = output_exists and need_digest
+    jobs = [asyncio.to_thread(_load_questions, input_file)]
+    if need_digest:
+        jobs.append(asyncio.to_thread(_file_digest, input_file))
+    if need_scan:
+        jobs.append(asyncio.to_thread(_scan_output, output_file))
+    job_results = await asyncio.gather(*jobs)
+    questions = job_results[0]
+    index.input_digest = job_results[1] if need_digest else saved[0]  # type: ignore[index]
+    processed_set: Optional[Set[str]] = job_results[-1] if need_scan else None
+
+    done: Optional[bytearray] = None
+    if saved is not None and saved[0] == index.input_digest:
+        done = saved[2]
+
+    # Excel 中重复的问题只请求一次（保持原有顺序）
+    unique_questions = list(dict.fromkeys(questions))
+    total = len(unique_questions)
 
-    processed_set: Set[str] = set()
     existing_count = 0
-    if resume and os.path.exists(output_file):
-        processed_set = _load_existing_records(output_file)
+    if done is not None and len(done) != total:
+        # 摘要一致时长度必然一致，这里只兜底损坏的索引
+        done = None
+        if processed_set is None:
+            processed_set = await asyncio.to_thread(_scan_output, output_file)
+    if done is not None:
+        existing_count = done.count(1)
+    elif processed_set is not None:
         existing_count = len(processed_set)
+        done = bytearray(q in processed_set for q in unique_questions)
+    processed_set = None  # 仅用于续跑过滤，之后不再查询
+    if output_exists:
         if existing_count:
             print(f"🔄 发现已有进度，已加载 {existing_count} 条数据")
         else:
             print("⚠️ 现有 JSONL 文件为空或无法读取，重新开始")
-    elif not resume and os.path.exists(output_file):
-        os.remove(output_file)
+    if done is None:
+        done = bytearray(total)
 
-    remaining = [q for q in questions if q not in processed_set]
+    remaining = [(idx, q) for idx, q in enumerate(unique_questions) if not done[idx]]
+    already_done = total - len(remaining)
 
-    pbar = tqdm(total=len(questions), desc="生成中", unit="条")
-    if existing_count:
-        pbar.update(existing_count)
+    pbar = tqdm(total=total, desc="生成中", unit="条", mininterval=0.5)
+    if already_done:
+        pbar.update(already_done)
 
-    question_iter = iter(remaining)
-    free_cache: Deque[CacheRecord] = deque()
-    inflight: Set[asyncio.Task] = set()
-    results_buffer: List[Dict[str, str]] = []
     total_processed = existing_count
-
-    def fill_cache() -> None:
-        while len(free_cache) < batch_size:
-            try:
-                q = next(question_iter)
-            except StopIteration:
-                break
-            free_cache.append(CacheRecord(instruction=q))
-
-    fill_cache()
-
-    while inflight or free_cache:
-        while len(inflight) < concurrency and free_cache:
-            record = free_cache.popleft()
-            task = asyncio.create_task(
-                _call_one(
-                    client,
-                    model,
-                    record.instruction,
-                    include_cot,
-                    think_tag,
-                    max_retries,
-                    base_prompt_value,
-                    dropout_fn,
-                )
+    pending_updates = 0
+    update_every = max(1, concurrency // 2)  # 攒够一批再刷新进度条，减少 tqdm 加锁与重绘
+    sem = asyncio.Semaphore(concurrency)
+    think_tags = (f"<{think_tag}>", f"</{think_tag}>")
+
+    pending: "asyncio.Queue[Optional[Tuple[int, str]]]" = asyncio.Queue()
+    results: "asyncio.Queue[Optional[Tuple[int, bytes]]]" = asyncio.Queue()
+    # 退避中的请求会让出并发名额，多备一倍 worker 让在途请求保持 concurrency 个
+    worker_count = min(len(remaining), 2 * concurrency)
+    for item in remaining:
+        pending.put_nowait(item)
+    for _ in range(worker_count):
+        pending.put_nowait(None)
+
+    async def worker() -> None:
+        nonlocal total_processed, pending_updates
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            idx, q = item
+            rec = await _call_one(
+                client,
+                model,
+                q,
+                include_cot,
+                think_tags,
+                max_retries,
+                base_prompt_value,
+                dropout_fn,
+                sem,
+                dropout_rate,
             )
-            inflight.add(task)
-
-        if not inflight:
-            fill_cache()
-            if not free_cache:
-                break
-            continue
-
-        done, pending = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
-        inflight = set(pending)
-        for task in done:
-            rec = task.result()
-            results_buffer.append(rec)
-            processed_set.add(rec["instruction"])
+            results.put_nowait((idx, rec))
             total_processed += 1
-            pbar.update(1)
-
-        fill_cache()
-
-        if len(results_buffer) >= save_every:
-            _flush_results(output_file, results_buffer)
-            print(f"💾 已写入缓存：{total_processed}/{len(questions)}")
-
-    # Flush remaining results
-    _flush_results(output_file, results_buffer)
+            pending_updates += 1
+            if pending_updates >= update_every:
+                pbar.update(pending_updates)
+                pending_updates = 0
+
+    # 重试统一由 _call_one 负责：SDK 内部重试会在退避期间一直占着并发名额
+    client = AsyncOpenAI(
+        base_url=api_base,
+        api_key=api_key,
+        max_retries=0,
+        http_client=_make_http_client(concurrency),
+    )
+    async with client:
+        with _open_output(output_file) as fh:
+            writer = asyncio.create_task(
+                _writer_loop(
+                    results,
+                    fh,
+                    save_every,
+                    already_done,
+                    total,
+                    done,
+                    index,
+                    # .gz 每次写回都是一个独立压缩块：空闲写回放缓到每秒至多一次
+                    GZIP_IDLE_FLUSH_INTERVAL if _is_gzip_path(output_file) else 0.0,
+                )
+            )
+            workers = [asyncio.create_task(worker()) for _ in range(worker_count)]
+            try:
+                running = set(workers)
+                while running:
+                    finished, running = await asyncio.wait(running | {writer}, return_when=asyncio.FIRST_COMPLETED)
+                    # writer 只会因写入失败（磁盘满等）提前结束：立即停止，避免继续消耗 API 额度
+                    if writer in finished:
+                        break
+                    running.discard(writer)
+                    for task in finished:
+                        task.result()
+            finally:
+                for task in workers:
+                    task.cancel()
+                pbar.update(pending_updates)
+                # Flush remaining results
+                results.put_nowait(None)
+                await writer
 
     pbar.close()
     print(f"✅ 共生成 {total_processed} 条数据，已保存到 {output_file}")
@@ -274,17 +742,17 @@ def main() -> None:
     parser = argparse.ArgumentParser(
         description="并发调用 OpenAI 兼容 API，批量生成 SFT 数据（JSONL 格式）"
     )
-    parser.add_argument("input_file", help="输入 Excel 文件 (含 question 列)")
+    parser.add_argument("input_file", help="输入 Excel / CSV / Parquet 文件 (含 question 列)")
     parser.add_argument(
         "-o",
         "--output",
         default="sft_data.jsonl",
-        help="输出 JSONL 文件 (默认: sft_data.jsonl)",
+        help="输出 JSONL 文件，以 .gz 结尾时写入 gzip 压缩 (默认: sft_data.jsonl)",
     )
     parser.add_argument("--api_base", default=os.getenv("API_BASE", ""), help="OpenAI API base URL")
     parser.add_argument("--api_key", default=os.getenv("API_KEY", ""), help="API key")
     parser.add_argument("--model", default=os.getenv("MODEL", ""), help="使用的模型名")
-    parser.add_argument("--batch_size", type=int, default=20, help="送入自由缓存的批大小")
+    parser.add_argument("--batch_size", type=int, default=20, help="兼容参数，并发由 --concurrency 控制")
     parser.add_argument("--sleep", type=float, default=0.0, help="兼容参数，无实际并发作用")
     parser.add_argument("--save_every", type=int, default=50, help="缓存累计多少条时写回 JSONL")
     parser.add_argument("--no_resume", action="store_true", help="不启用断点续跑")
@@ -297,6 +765,18 @@ def main() -> None:
         default=None,
         help="读取外部 Markdown 文件作为 system prompt",
     )
+    parser.add_argument(
+        "--dropout_rate",
+        type=float,
+        default=0.5,
+        help="system prompt 逐行随机丢弃概率，0 表示不丢弃 (默认 0.5)",
+    )
+    parser.add_argument(
+        "--prompt_variants",
+        type=int,
+        default=64,
+        help="dropout 后最多复用的 system prompt 版本数，0 表示每次重新生成 (默认 64)",
+    )
     args = parser.parse_args()
 
     asyncio.run(
@@ -315,6 +795,8 @@ def main() -> None:
             max_retries=args.max_retries,
             concurrency=args.concurrency,
             system_prompt_markdown=args.system_prompt_markdown,
+            dropout_rate=args.dropout_rate,
+            prompt_variants=args.prompt_variants,
         )
     )
 